@@ -1,25 +1,46 @@
-import datetime
+import logging
 import math
 import os
 import sys
 
+import cv2
 import numpy as np
 import tifffile
 
 from jnormcorre import motion_correction
 from jnormcorre.utils import registrationarrays
 from typing import *
+from jax.typing import DTypeLike
 
 from jnormcorre.utils.lazy_array import lazy_data_loader
 
 
-def display(msg):
+def available_cpus() -> int:
     """
-    Printing utility that logs time and flushes.
+    Number of CPUs this process may run on. Unlike os.cpu_count(), this respects taskset / cgroup CPU affinity
+    (e.g. in containers and on shared CI runners).
     """
-    tag = '[' + datetime.datetime.today().strftime('%y-%m-%d %H:%M:%S') + ']: '
-    sys.stdout.write(tag + msg + '\n')
-    sys.stdout.flush()
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+logger = logging.getLogger("jnormcorre.demo")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('[%(asctime)s]: %(message)s', datefmt='%y-%m-%d %H:%M:%S'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def display(msg, *args):
+    """
+    Printing utility that logs time and flushes. Goes through the "jnormcorre.demo" logger (INFO level), so the
+    timestamp and message are only formatted if the message is actually emitted; silence it with
+    logging.getLogger("jnormcorre.demo").setLevel(logging.WARNING).
+    """
+    logger.info(msg, *args)
 
 
 def motion_correct_pipeline(lazy_dataset: lazy_data_loader,
@@ -36,17 +57,31 @@ def motion_correct_pipeline(lazy_dataset: lazy_data_loader,
                             gSig_filt: tuple[float, float] = None,
                             save_movie: bool = True,
                             min_mov: Optional[float] = None,
-                            template: Optional[np.ndarray] = None):
+                            template: Optional[np.ndarray] = None,
+                            shift_method: str = "fft",
+                            dtype_corr: DTypeLike = np.float32,
+                            threads: Optional[int] = None,
+                            compression: Optional[str] = None):
     """
     Runs the full motion correction pipeline (with the option to do rigid and piecewise rigid registration after)
-    See documentation for parameter details
+    See documentation for parameter details. threads sets the number of OpenCV threads used by the CPU side of the
+    pipeline (high-pass filtering with gSig_filt); it defaults to the number of CPUs available to this process.
+    threads does not affect the BLAS / OpenMP thread pools, which are sized when numpy is imported; set
+    OMP_NUM_THREADS, MKL_NUM_THREADS or OPENBLAS_NUM_THREADS in the environment to change them.
     """
+    cv2.setNumThreads(available_cpus() if threads is None else threads)
+
     corrector = motion_correction.MotionCorrect(lazy_dataset, max_shifts=max_shifts, frames_per_split=frames_per_split,
                                                 num_splits_to_process_rig=num_splits_to_process_rig,
                                                 niter_rig=niter_rig, pw_rigid=pw_rigid, strides=strides,
                                                 overlaps=overlaps, max_deviation_rigid=max_deviation_rigid,
                                                 num_splits_to_process_els=num_splits_to_process_els, min_mov=min_mov,
-                                                gSig_filt=gSig_filt)
+                                                gSig_filt=gSig_filt, shift_method=shift_method,
+                                                dtype_corr=dtype_corr, compression=compression)
+
+    # Compile the registration kernels up front; set JAX_COMPILATION_CACHE_DIR to reuse them across runs
+    corrector.warmup()
+    display("Registration kernels compiled.")
 
     # Run MC, Always Saving Non-Final Outputs For Use In Next Iteration
     frame_corrector_obj, target_file = corrector.motion_correct(
@@ -56,11 +91,12 @@ def motion_correct_pipeline(lazy_dataset: lazy_data_loader,
     display("Motion correction completed.")
 
     # Save Frame-wise Shifts
-    display(f"Saving computed shifts to ({outdir})...")
-    np.savez(os.path.join(outdir, "shifts.npz"),
-             shifts_rig=corrector.shifts_rig,
-             x_shifts_els=corrector.x_shifts_els if pw_rigid else None,
-             y_shifts_els=corrector.y_shifts_els if pw_rigid else None)
+    display("Saving computed shifts to (%s)...", outdir)
+    # Shifts are a few pixels at most, float32 loses no useful precision and compresses well
+    np.savez_compressed(os.path.join(outdir, "shifts.npz"),
+                        shifts_rig=np.asarray(corrector.shifts_rig, dtype=np.float32),
+                        x_shifts_els=np.asarray(corrector.x_shifts_els, dtype=np.float32) if pw_rigid else None,
+                        y_shifts_els=np.asarray(corrector.y_shifts_els, dtype=np.float32) if pw_rigid else None)
     display('Shifts saved as "shifts.npz".')
 
     return frame_corrector_obj, target_file
@@ -83,8 +119,8 @@ def main():
         max_shift_um = (
             12.,
             12.)  # This is the maximum rigid shift of the data in um (so this is in physical space, not pixel space)
-        max_shifts = [int(a / b) for a, b in zip(max_shift_um,
-                                                 dxy)]  # Based on the above physical parameters, we can define the max shifts for rigid registration and the strides
+        max_shifts = tuple(int(a / b) for a, b in zip(max_shift_um,
+                                                      dxy))  # Based on the above physical parameters, we can define the max shifts for rigid registration and the strides
 
         pw_rigid = True  # You can turn this off to disable piecewise rigid registration
 
@@ -6,10 +6,12 @@ import datetime
 from builtins import range
 from builtins import str
 import jax
-import torch
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from past.utils import old_div
 from typing import *
-from jax.typing import ArrayLike
+from jax.typing import ArrayLike, DTypeLike
 from jnormcorre.utils.lazy_array import lazy_data_loader
 
 logging.basicConfig(level=logging.ERROR)
@@ -25,13 +27,17 @@ from jax import jit, vmap
 from functools import partial
 import random
 
+# Split size of the piecewise rigid passes; MotionCorrect's frames_per_split only applies to the rigid passes
+_PWRIGID_FRAMES_PER_SPLIT = 1000
+
 
 class frame_corrector():
     def __init__(self, template: np.ndarray,
                  max_shifts: Tuple[int, int], strides: Tuple[int, int],
                  overlaps: Tuple[int, int], max_deviation_rigid: int,
                  min_mov: Optional[float] = None,
-                 batching: int = 100) -> None:
+                 batching: int = 100, rigid_crop: Optional[Tuple[int, int]] = None,
+                 shift_method: str = "fft") -> None:
         """
         Standalone motion correction object, allowing users to register frames via rigid or piecewise
         rigid motion correction to a given template.
@@ -44,9 +50,11 @@ class frame_corrector():
             max_deviation_rigid (int): Specifies max number of pixels a patch can deviate from the rigid shifts.
             min_mov (float): The minimum value of the movie, if known.
             batching (int): Specifies how many frames we register at a time. Toggle this to avoid GPU OOM errors.
+            rigid_crop (Tuple): Optional. Two integers; rigid shifts are estimated on the central window of this size.
+                See MotionCorrect for details.
+            shift_method (str): "fft" or "bilinear", how rigid shifts are applied. See MotionCorrect for details.
         """
-        self.template = template
-        self.max_shifts = max_shifts
+        self.max_shifts = canonical_int_pair("max_shifts", max_shifts)
         self.upsample_factor_fft = 10
 
         if min_mov is not None:
@@ -54,10 +62,13 @@ class frame_corrector():
         else:
             self.add_to_movie = 0
 
-        self.strides = strides
-        self.overlaps = overlaps
+        self.strides = canonical_int_pair("strides", strides)
+        self.overlaps = canonical_int_pair("overlaps", overlaps)
         self.max_deviation_rigid = max_deviation_rigid
         self.batching = batching
+        self.rigid_crop = canonical_int_pair("rigid_crop", rigid_crop)
+        self.shift_method = shift_method
+        self.template = template
 
         # Set the pwrigid function
         self.pw_registration_method = jit(
@@ -72,13 +83,29 @@ class frame_corrector():
         self.jitted_pwrigid_method = simplified_registration_func_pw
 
         # Set the rigid function
-        self.rigid_registration_method = jit(vmap(_register_to_template_rigid, in_axes=(0, None, None, None)))
+        self.rigid_registration_method = register_frames_to_template_rigid
 
         def simplified_registration_func_rig(frames: np.ndarray) -> ArrayLike:
-            return self.rigid_registration_method(frames, self.template, self.max_shifts, self.add_to_movie)[0]
+            return self.rigid_registration_method(frames, self.template, self.max_shifts, self.add_to_movie,
+                                                  crop_dims=self.rigid_crop,
+                                                  shift_method=self.shift_method,
+                                                  template_freq=self.template_freq)[0]
 
         self.jitted_rigid_method = simplified_registration_func_rig
 
+    @property
+    def template(self) -> np.ndarray:
+        """
+        The template frames are registered to. Assigning a new template also recomputes the template spectrum used
+        by the rigid registration function.
+        """
+        return self._template
+
+    @template.setter
+    def template(self, template: np.ndarray) -> None:
+        self._template = template
+        self.template_freq = get_template_freq_jax(template, self.add_to_movie, crop_dims=self.rigid_crop)
+
     def register_frames(self, frames: np.ndarray, pw_rigid: bool = False) -> np.ndarray:
         """
         Function to register a set of frames to this object's template.
@@ -111,6 +138,21 @@ class frame_corrector():
         return self.jitted_pwrigid_method
 
 
+def canonical_int_pair(name: str, value: Optional[Sequence[int]]) -> Optional[tuple[int, int]]:
+    """
+    Returns value (e.g. max_shifts, strides or overlaps) as a tuple of two python ints. These values end up as static
+    arguments / pytree structure of the jitted registration functions, where a list, a tuple of numpy integers and a
+    tuple of python ints are not interchangeable; canonicalizing them once means every call hits the same compiled
+    function.
+    """
+    if value is None:
+        return None
+    pair = tuple(int(v) for v in value)
+    if len(pair) != 2 or any(p != v for p, v in zip(pair, value)):
+        raise ValueError(f"{name} must contain two integers, got {value}.")
+    return pair
+
+
 def verify_strides_and_overlaps(dim: int, stride: int, overlap: int) -> None:
     if not stride > 0:
         raise ValueError(
@@ -146,13 +188,19 @@ class MotionCorrect(object):
                  pw_rigid: bool = False, strides: tuple[int, int] = (96, 96), overlaps: tuple[int, int] = (32, 32),
                  max_deviation_rigid: int = 3, num_splits_to_process_els: Optional[int] = None,
                  niter_els: int = 1, min_mov: float = None, upsample_factor_grid: int = 4,
-                 gSig_filt: Optional[list[int]] = None, bigtiff: bool = False) -> None:
+                 gSig_filt: Optional[list[int]] = None, bigtiff: bool = False,
+                 rigid_crop: Optional[tuple[int, int]] = None, shift_method: str = "fft",
+                 dtype_corr: DTypeLike = np.float32, time_axis: int = 0,
+                 compression: Optional[str] = None) -> None:
 
         """
         Constructor class for motion correction operations
 
         Args:
-            lazy_dataset (lazy_data_loader): Lazy data loader for loading frames of the data
+            lazy_dataset (lazy_data_loader): Lazy data loader for loading frames of the data, or an in-memory
+                array. Frames must be indexed along the first axis, i.e. shape (T, d1, d2), unless time_axis is
+                given. The data does not need to be contiguous in memory; each split is copied into a contiguous
+                (frames, d1, d2) float32 buffer before registration.
             max_shifts (Tuple): Two integers, specifying maximum shift in the two FOV dimensions (height, width)
             frames_per_split (int): Integer larger than 1. Number of frames we use to generate each local template.
             num_splits_to_process_rig (int): Number of splits we process per iteration of rigid motion correction
@@ -160,6 +208,9 @@ class MotionCorrect(object):
             pw_rigid (bool): Whether we additionally run piecewise rigid registration
             strides (Tuple): Two integers, used to specify patch dimensions for pwrigid registration
             overlaps (Tuple): Overlap b/w patches. strides[i] + overlaps[i] are the patch size dimensions.
+                max_shifts, strides, overlaps (and rigid_crop) may be given as any sequence of two integral values;
+                they are stored as tuples of python ints so that all jitted registration calls share one compiled
+                function per shape.
             max_deviation_rigid (int): Specifies max number of pixels a patch can deviate from the rigid shifts.
             num_splits_to_process_els (int): Number of splits we process per iteration of pwrigid motion correction
             niter_els: Number of iterations of piecewise rigid registration
@@ -167,6 +218,26 @@ class MotionCorrect(object):
             gSig_filt (list): List with 1 positive integer describing a Gaussian standard deviation. We use this to construct a kernel to
                 high-pass filter data which has large background contamination.
             bigtiff (bool): Indicates whether or not movie is saved as a bigtiff or regular tiff
+            compression (str): Optional. Compression of the saved movie, any codec supported by
+                tifffile.TiffWriter.write, e.g. "zlib" or "zstd". Frames are compressed one page at a time while the
+                next split is registered. Compressed files can be read with tifffile.imread / TiffArray, but can not
+                be opened with tifffile.memmap. Default is None (uncompressed).
+            rigid_crop (Tuple): Optional. Two integers (height, width). If given, rigid shifts are estimated on a centered
+                window of this size (clipped to the FOV) and then applied to the full frames. All pixels share the same
+                rigid shift, so e.g. (512, 512) is usually enough for large FOVs and makes the FFTs much cheaper.
+                The window must contain enough texture to register, and must be larger than 2 * max_shifts.
+            shift_method (str): How rigid shifts are applied to the frames. "fft" (default) shifts them exactly in the
+                frequency domain, which costs a forward and an inverse FFT per frame. "bilinear" resamples the frames
+                by bilinear interpolation instead (as piecewise rigid registration already does), which is cheaper
+                but slightly low-pass filters the registered frames. Shift estimation is the same for both.
+            dtype_corr (dtype): Precision of the high-pass filtered frames which are used (only) to estimate the
+                shifts when gSig_filt is set. One of float32 (default), bfloat16 or float16. The low precision types
+                halve the memory and host to device traffic of the filtered frames; the FFTs are still computed in
+                float32, and the registered frames are always computed from the float32 data.
+            time_axis (int): Axis of lazy_dataset which indexes frames. For an in-memory np.ndarray stored e.g. as
+                (d1, d2, T), pass time_axis=2 instead of transposing it: the array is only viewed with the frame axis
+                first, and just the frames of each split are copied. lazy_data_loader datasets always index frames
+                along axis 0.
         """
         if not isinstance(niter_els, int) or niter_els < 1:
             raise ValueError(f"please provide niter_els as an int of 1 or higher.")
@@ -174,6 +245,26 @@ class MotionCorrect(object):
         if not isinstance(niter_rig, int) or niter_rig < 1:
             raise ValueError(f"please provide niter_rig as an int of 1 or higher.")
 
+        if shift_method not in ("fft", "bilinear"):
+            raise ValueError(f"shift_method must be 'fft' or 'bilinear', got {shift_method}.")
+
+        if jnp.dtype(dtype_corr) not in (jnp.float32, jnp.bfloat16, jnp.float16):
+            raise ValueError(f"dtype_corr must be float32, bfloat16 or float16, got {dtype_corr}.")
+
+        max_shifts = canonical_int_pair("max_shifts", max_shifts)
+        strides = canonical_int_pair("strides", strides)
+        overlaps = canonical_int_pair("overlaps", overlaps)
+        rigid_crop = canonical_int_pair("rigid_crop", rigid_crop)
+
+        if rigid_crop is not None and not all(c > 2 * m for c, m in zip(rigid_crop, max_shifts)):
+            raise ValueError(f"rigid_crop {rigid_crop} must be larger than 2 * max_shifts {max_shifts}.")
+
+        if time_axis != 0:
+            if not isinstance(lazy_dataset, np.ndarray):
+                raise ValueError(f"time_axis={time_axis} is only supported for np.ndarray data, "
+                                 f"lazy_data_loader datasets must index frames along axis 0.")
+            lazy_dataset = np.moveaxis(lazy_dataset, time_axis, 0)
+
         self.lazy_dataset = lazy_dataset
         self.max_shifts = max_shifts
         self.niter_rig = niter_rig
@@ -188,6 +279,10 @@ class MotionCorrect(object):
         self.min_mov = min_mov
         self.pw_rigid = bool(pw_rigid)
         self.bigtiff = bigtiff
+        self.compression = compression
+        self.rigid_crop = rigid_crop
+        self.shift_method = shift_method
+        self.dtype_corr = jnp.dtype(dtype_corr)
         self.file_FOV_dims = self.lazy_dataset.shape[1], self.lazy_dataset.shape[2]
         self.file_num_frames = self.lazy_dataset.shape[0]
 
@@ -243,9 +338,54 @@ class MotionCorrect(object):
             template = self.total_template_rig
         frame_correction_obj = frame_corrector(template, self.max_shifts,
                                                self.strides, self.overlaps,
-                                               self.max_deviation_rigid, min_mov=self.min_mov)
+                                               self.max_deviation_rigid, min_mov=self.min_mov,
+                                               rigid_crop=self.rigid_crop, shift_method=self.shift_method)
         return frame_correction_obj, self.target_file
 
+    def warmup(self, shape: Optional[tuple[int, int]] = None) -> None:
+        """
+        Compiles the jitted registration functions which motion_correct will use, for the frame shape and the batch
+        sizes which the split heuristics produce, by registering blank frames. This moves the compilation out of the
+        first split; combined with JAX's persistent compilation cache (set the JAX_COMPILATION_CACHE_DIR environment
+        variable, or jax.config.update("jax_compilation_cache_dir", ...)) later runs on data of the same shape and with
+        the same parameters skip compilation altogether.
+
+        Args:
+            shape (tuple): Optional. FOV dimensions (d1, d2) to compile for; defaults to the FOV of lazy_dataset.
+                The number of frames is always taken from lazy_dataset.
+        """
+        d1, d2 = self.file_FOV_dims if shape is None else canonical_int_pair("shape", shape)
+        num_frames = self.file_num_frames
+        template = np.zeros((d1, d2), dtype=np.float32)
+        add_to_movie = np.array(0, dtype=np.float32)
+        split_constant = load_split_heuristic(d1, d2, num_frames)
+
+        # The rigid passes split the movie by frames_per_split, the pwrigid passes by _PWRIGID_FRAMES_PER_SPLIT
+        passes = [(0, self.frames_per_split)]
+        if self.pw_rigid:
+            passes.append((self.max_deviation_rigid, _PWRIGID_FRAMES_PER_SPLIT))
+
+        for max_deviation_rigid, frames_per_split in passes:
+            # Mirror calculate_splits and the batching in _tile_and_correct_dataloader
+            split_size = min(num_frames, frames_per_split)
+            batch_sizes = {min(split_constant, split_size)}
+            if split_size % split_constant:
+                batch_sizes.add(split_size % split_constant)
+
+            template_freq = None
+            if max_deviation_rigid == 0:
+                template_freq = get_template_freq_jax(template, add_to_movie, crop_dims=self.rigid_crop)
+            for batch_size in sorted(batch_sizes):
+                imgs = np.zeros((batch_size, d1, d2), dtype=np.float32)
+                imgs_filtered = None
+                if self.filter_kernel is not None:
+                    imgs_filtered = _shard_frames(high_pass_batch(self.filter_kernel, imgs).astype(self.dtype_corr))
+                imgs = _shard_frames(imgs)
+                outs = _register_batch(imgs, imgs_filtered, template, template_freq, self.strides, self.overlaps,
+                                       self.max_shifts, add_to_movie, max_deviation_rigid,
+                                       rigid_crop=self.rigid_crop, shift_method=self.shift_method)
+                jax.block_until_ready(outs)
+
     def _motion_correct_rigid(self, template: Optional[np.ndarray] = None,
                               save_movie: Optional[bool] = False) -> None:
         """
@@ -270,7 +410,11 @@ class MotionCorrect(object):
             save_movie_rigid=save_movie,
             add_to_movie=-self.min_mov,
             filter_kernel=self.filter_kernel,
-            bigtiff=self.bigtiff)
+            bigtiff=self.bigtiff,
+            rigid_crop=self.rigid_crop,
+            shift_method=self.shift_method,
+            dtype_corr=self.dtype_corr,
+            compression=self.compression)
         if template is None:
             self.total_template_rig = _total_template_rig
 
@@ -307,7 +451,8 @@ class MotionCorrect(object):
             self.lazy_dataset, self.max_shifts, self.strides, self.overlaps, -self.min_mov,
             upsample_factor_grid=self.upsample_factor_grid, max_deviation_rigid=self.max_deviation_rigid,
             num_splits_to_process=self.num_splits_to_process_els, num_iter=num_iter, template=self.total_template_els,
-            save_movie=save_movie, filter_kernel=self.filter_kernel, bigtiff=self.bigtiff)
+            save_movie=save_movie, filter_kernel=self.filter_kernel, bigtiff=self.bigtiff,
+            dtype_corr=self.dtype_corr, compression=self.compression)
 
         if np.isnan(np.sum(new_template_els)):
             raise Exception(
@@ -327,7 +472,11 @@ def _motion_correct_batch_rigid(lazy_dataset: lazy_data_loader, max_shifts: tupl
                                 frames_per_split: int = 1000, num_splits_to_process: int = None, num_iter: int = 1,
                                 template: np.ndarray = None, save_movie_rigid: bool = False, add_to_movie: float = None,
                                 filter_kernel: np.ndarray = None,
-                                bigtiff: bool = False) -> tuple[str, np.ndarray, list, list]:
+                                bigtiff: bool = False,
+                                rigid_crop: Optional[tuple[int, int]] = None,
+                                shift_method: str = "fft",
+                                dtype_corr: DTypeLike = np.float32,
+                                compression: Optional[str] = None) -> tuple[str, np.ndarray, list, list]:
     """
     Performs 1 pass of rigid motion correction; see the following functions for parameter details:
         (1) MotionCorrection object constructor
@@ -382,7 +531,10 @@ def _motion_correct_batch_rigid(lazy_dataset: lazy_data_loader, max_shifts: tupl
                                                                       save_movie=save_flag,
                                                                       num_splits=num_splits_to_process,
                                                                       filter_kernel=filter_kernel,
-                                                                      bigtiff=bigtiff)
+                                                                      bigtiff=bigtiff, rigid_crop=rigid_crop,
+                                                                      shift_method=shift_method,
+                                                                      dtype_corr=dtype_corr,
+                                                                      compression=compression)
 
         new_templ = np.nanmedian(np.dstack([r[-1] for r in res_rig]), -1)
         if filter_kernel is not None:
@@ -403,11 +555,13 @@ def _motion_correct_batch_rigid(lazy_dataset: lazy_data_loader, max_shifts: tupl
 def _motion_correct_batch_pwrigid(lazy_dataset: lazy_data_loader, max_shifts: tuple[int, int], strides: tuple[int, int],
                                   overlaps: tuple[int, int], add_to_movie: float,
                                   upsample_factor_grid: int = 4, max_deviation_rigid: int = 3,
-                                  frames_per_split: int = 1000, num_splits_to_process: Optional[int] = None,
-                                  num_iter: int = 1,
+                                  frames_per_split: int = _PWRIGID_FRAMES_PER_SPLIT,
+                                  num_splits_to_process: Optional[int] = None, num_iter: int = 1,
                                   template: Optional[np.ndarray] = None, save_movie: bool = False,
                                   filter_kernel: Optional[np.ndarray] = None,
-                                  bigtiff=False) -> tuple[str, np.ndarray, list, list, list, list, list]:
+                                  bigtiff=False,
+                                  dtype_corr: DTypeLike = np.float32,
+                                  compression: Optional[str] = None) -> tuple[str, np.ndarray, list, list, list, list, list]:
     """
     Performs 1 pass of piecewise rigid motion correction; see the following functions for parameter details:
         (1) MotionCorrection object constructor
@@ -453,7 +607,8 @@ def _motion_correct_batch_pwrigid(lazy_dataset: lazy_data_loader, max_shifts: tu
                                                                      save_movie=save_flag,
                                                                      num_splits=num_splits_to_process,
                                                                      filter_kernel=filter_kernel,
-                                                                     bigtiff=bigtiff)
+                                                                     bigtiff=bigtiff, dtype_corr=dtype_corr,
+                                                                     compression=compression)
 
         new_templ = np.nanmedian(np.dstack([r[-1] for r in res_el]), -1)
         if filter_kernel is not None:
@@ -485,7 +640,11 @@ def _execute_motion_correction_iteration(lazy_dataset: lazy_data_loader, frames_
                                          upsample_factor_grid: int = 4,
                                          save_movie: bool = True, num_splits: Optional[int] = None,
                                          filter_kernel: np.ndarray = None,
-                                         bigtiff: bool = False) -> tuple[str, list[tuple]]:
+                                         bigtiff: bool = False,
+                                         rigid_crop: Optional[tuple[int, int]] = None,
+                                         shift_method: str = "fft",
+                                         dtype_corr: DTypeLike = np.float32,
+                                         compression: Optional[str] = None) -> tuple[str, list[tuple]]:
     """
     Executes a single iteration of motion correction. See the following functions for details:
     (1) MotionCorrection constructor
@@ -525,74 +684,77 @@ def _execute_motion_correction_iteration(lazy_dataset: lazy_data_loader, frames_
              filter_kernel])
 
     split_constant = load_split_heuristic(dims[0], dims[1], T)
-    res = _tile_and_correct_dataloader(pars, lazy_dataset, split_constant=split_constant, bigtiff=bigtiff)
+    res = _tile_and_correct_dataloader(pars, lazy_dataset, split_constant=split_constant, bigtiff=bigtiff,
+                                       rigid_crop=rigid_crop, shift_method=shift_method, dtype_corr=dtype_corr,
+                                       compression=compression)
     return fname_tot, res
 
 
-def _tile_and_correct_dataloader(param_list, lazy_dataset, split_constant=200, bigtiff=False) -> list[tuple]:
+def _tile_and_correct_dataloader(param_list, lazy_dataset, split_constant=200, bigtiff=False,
+                                 rigid_crop=None, shift_method="fft", dtype_corr=np.float32,
+                                 compression=None) -> list[tuple]:
     """
     See _execute_motion_correction_iteration for details on what parameters this function uses to perform registration.
-    If specified, writes corrected frames to a tiff memmap file (name given by out_fname)
+    If specified, streams the corrected frames to a tiff file (name given by out_fname) in a background thread.
     """
-    num_workers = 0
     movie_shape = lazy_dataset.shape
     tile_and_correct_dataobj = tile_and_correct_dataset(param_list)
-    loader_obj = torch.utils.data.DataLoader(tile_and_correct_dataobj, batch_size=1,
-                                             shuffle=False, num_workers=num_workers, collate_fn=regular_collate,
-                                             timeout=0)
+    loader_obj = prefetch_splits(tile_and_correct_dataobj)
 
     results_list = []
-    start_pt_save = 0
-    memmap_placeholder = None
-    for dataloader_index, data in enumerate(tqdm(loader_obj), 0):
-        num_iters = math.ceil(data[0].shape[0] / split_constant)
-        imgs_net, mc, out_fname, idxs, template, strides, overlaps, max_shifts, \
-            add_to_movie, max_deviation_rigid, upsample_factor_grid, \
-            filter_kernel = data
-        if out_fname is not None:
-            if memmap_placeholder is None:
-                memmap_placeholder = tifffile.memmap(out_fname, shape=movie_shape, dtype=mc.dtype,
-                                                     bigtiff=bigtiff)
-        for j in range(num_iters):
-
-            start_pt = split_constant * j
-            end_pt = min(data[0].shape[0], start_pt + split_constant)
-            imgs = imgs_net[start_pt:end_pt, :, :]
-            shift_info = []
-            upsample_factor_fft = 10  # Hardcoded from original method
-
-            if max_deviation_rigid == 0:
-                if filter_kernel is None:
-                    outs = register_frames_to_template_rigid(imgs, template, max_shifts, add_to_movie)
-                else:
-                    imgs_filtered = high_pass_batch(filter_kernel, imgs)
-                    outs = register_frames_to_template_1p_rigid(imgs, imgs_filtered, template, max_shifts, add_to_movie)
-                mc[start_pt:end_pt, :, :] = outs[0]
-                shift_info.extend([[k] for k in np.array(outs[1])])
-            else:
-                if filter_kernel is None:
-                    outs = register_frames_to_template_pwrigid(imgs, template, strides[0], strides[1], overlaps[0],
-                                                               overlaps[1], \
-                                                               max_shifts, upsample_factor_fft, max_deviation_rigid,
-                                                               add_to_movie)
-                else:
-                    imgs_filtered = high_pass_batch(filter_kernel, imgs)
-                    outs = register_frames_to_template_1p_pwrigid(imgs, imgs_filtered, template, strides[0], strides[1],
-                                                                  overlaps[0], overlaps[1], \
-                                                                  max_shifts, upsample_factor_fft, max_deviation_rigid,
-                                                                  add_to_movie)
-
-                mc[start_pt:end_pt, :, :] = outs[0]
-                shift_info.extend([[k] for k in np.array(outs[1])])
-
-        if out_fname is not None:
-            memmap_placeholder[idxs, :, :] = mc
-            start_pt_save += mc.shape[0]
-            memmap_placeholder.flush()
-        new_temp = generate_template_chunk(mc)
-
-        results_list.append((shift_info, idxs, new_temp))
-
+    writer = None
+    template_freq = None
+    completed = False
+    try:
+        for dataloader_index, data in enumerate(tqdm(loader_obj, total=len(tile_and_correct_dataobj)), 0):
+            num_iters = math.ceil(data[0].shape[0] / split_constant)
+            imgs_net, mc, out_fname, idxs, template, strides, overlaps, max_shifts, \
+                add_to_movie, max_deviation_rigid, upsample_factor_grid, \
+                filter_kernel = data
+            # The kernels compute in float32 anyway; fixing the dtypes here (a python int add_to_movie would be
+            # weakly typed) keeps the jit cache keys independent of how they were computed, so MotionCorrect.warmup
+            # can match them
+            template = np.asarray(template, dtype=np.float32)
+            add_to_movie = np.asarray(add_to_movie, dtype=np.float32)
+            if out_fname is not None:
+                if writer is None:
+                    writer = tiff_split_writer(out_fname, movie_shape, dtype=mc.dtype, bigtiff=bigtiff,
+                                               compression=compression)
+            for j in range(num_iters):
+
+                start_pt = split_constant * j
+                end_pt = min(data[0].shape[0], start_pt + split_constant)
+                imgs = imgs_net[start_pt:end_pt, :, :]
+                shift_info = []
+
+                num_frames = imgs.shape[0]
+                imgs_filtered = None
+                if filter_kernel is not None:
+                    # The filtered frames are only used to estimate the shifts, so they can be kept in lower precision
+                    imgs_filtered = _shard_frames(high_pass_batch(filter_kernel, imgs).astype(dtype_corr))
+                imgs = _shard_frames(imgs)
+
+                # Every split of an iteration is registered to the same template, so transform it only once
+                if max_deviation_rigid == 0 and template_freq is None:
+                    template_freq = get_template_freq_jax(template, add_to_movie, crop_dims=rigid_crop)
+
+                outs = _register_batch(imgs, imgs_filtered, template, template_freq, strides, overlaps, max_shifts,
+                                       add_to_movie, max_deviation_rigid, rigid_crop=rigid_crop,
+                                       shift_method=shift_method)
+                mc[start_pt:end_pt, :, :] = outs[0][:num_frames]
+                shift_info.extend([[k] for k in np.array(outs[1][:num_frames])])
+
+            if out_fname is not None:
+                writer.write(idxs, mc)
+            new_temp = generate_template_chunk(mc)
+
+            results_list.append((shift_info, idxs, new_temp))
+        completed = True
+    finally:
+        # Always stop the writer thread and close the file, also if registration fails or is interrupted
+        loader_obj.close()
+        if writer is not None:
+            writer.close(abort=not completed)
     return results_list
 
 
@@ -612,7 +774,9 @@ class tile_and_correct_dataset():
             add_to_movie, max_deviation_rigid, upsample_factor_grid, \
             filter_kernel = self.param_list[index]
 
-        imgs = lazy_dataset[idxs, :, :]
+        # One C-contiguous, time-major float32 copy per split so that every frame is a unit-stride block for the FFTs
+        # (strided inputs such as transposed arrays would otherwise be read with large strides on every transfer)
+        imgs = np.ascontiguousarray(lazy_dataset[idxs, :, :], dtype=np.float32)
         mc = np.zeros(imgs.shape, dtype=np.float32)
 
         return imgs, mc, out_fname, idxs, template, strides, overlaps, max_shifts, \
@@ -648,8 +812,123 @@ def nan_processing(arr: ArrayLike) -> ArrayLike:
     return r
 
 
-def regular_collate(batch):
-    return batch[0]
+def _register_batch(imgs: ArrayLike, imgs_filtered: Optional[ArrayLike], template: ArrayLike,
+                    template_freq: Optional[ArrayLike], strides: Optional[tuple[int, int]],
+                    overlaps: Optional[tuple[int, int]], max_shifts: tuple[int, int], add_to_movie: ArrayLike,
+                    max_deviation_rigid: int, rigid_crop: Optional[tuple[int, int]] = None,
+                    shift_method: str = "fft") -> tuple[ArrayLike, ArrayLike]:
+    """
+    Registers one batch of frames with the jitted function matching the mode: rigid (max_deviation_rigid == 0) or
+    piecewise rigid, with (imgs_filtered given) or without high-pass filtered frames for shift estimation.
+    Shared by _tile_and_correct_dataloader and MotionCorrect.warmup, so both compile exactly the same functions.
+
+    Returns:
+        outs (tuple): Registered frames and shifts of the batch.
+    """
+    upsample_factor_fft = 10  # Hardcoded from original method
+    if max_deviation_rigid == 0:
+        if imgs_filtered is None:
+            return register_frames_to_template_rigid(imgs, template, max_shifts, add_to_movie,
+                                                     crop_dims=rigid_crop, shift_method=shift_method,
+                                                     template_freq=template_freq)
+        return register_frames_to_template_1p_rigid(imgs, imgs_filtered, template, max_shifts, add_to_movie,
+                                                    crop_dims=rigid_crop, shift_method=shift_method,
+                                                    template_freq=template_freq)
+    if imgs_filtered is None:
+        return register_frames_to_template_pwrigid(imgs, template, strides[0], strides[1], overlaps[0], overlaps[1],
+                                                   max_shifts, upsample_factor_fft, max_deviation_rigid, add_to_movie)
+    return register_frames_to_template_1p_pwrigid(imgs, imgs_filtered, template, strides[0], strides[1],
+                                                  overlaps[0], overlaps[1], max_shifts, upsample_factor_fft,
+                                                  max_deviation_rigid, add_to_movie)
+
+
+class tiff_split_writer():
+    """
+    Streams registered splits to a single series tiff file from a background thread, so that compressing and writing
+    split i to disk overlaps with the registration of split i + 1. Splits must be passed in order (as planned by
+    calculate_splits when the movie is saved); frames which were already written by the previous, overlapping split
+    are skipped.
+    """
+
+    def __init__(self, out_fname: str, shape: tuple[int, int, int], dtype: DTypeLike = np.float32,
+                 bigtiff: bool = False, compression: Optional[str] = None) -> None:
+        self.shape = shape
+        self.dtype = dtype
+        # One split waiting for the writer at most, which bounds the extra memory to one split
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(out_fname, bigtiff, compression))
+        self._thread.start()
+
+    def _frames(self) -> Iterator[np.ndarray]:
+        written = 0
+        while written < self.shape[0]:
+            split = self._queue.get()
+            if split is None:
+                return
+            idxs, frames = split
+            if idxs.start > written:
+                raise ValueError(f"Splits must be written in order, frame {written} is missing")
+            for frame in frames[written - idxs.start:]:
+                yield frame
+                written += 1
+
+    def _run(self, out_fname, bigtiff, compression):
+        try:
+            with tifffile.TiffWriter(out_fname, bigtiff=bigtiff) as tif:
+                tif.write(self._frames(), shape=self.shape, dtype=self.dtype, compression=compression)
+        except Exception as e:
+            self._error = e
+
+    def _put(self, item):
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not self._thread.is_alive():
+                    raise RuntimeError("The tiff writer thread stopped unexpectedly")
+
+    def write(self, idxs: slice, frames: np.ndarray) -> None:
+        """
+        Queues the registered frames of the split idxs for writing; blocks while the previous split is still queued.
+        """
+        self._put((idxs, frames))
+
+    def close(self, abort: bool = False) -> None:
+        """
+        Waits until all frames are written and the file is closed.
+
+        Args:
+            abort (bool): Set if registration failed; the frames queued so far are written, the (incomplete) file is
+                closed and errors of the writer are not raised, so they don't mask the original exception.
+        """
+        if self._thread.is_alive():
+            try:
+                self._put(None)
+            except Exception:
+                if not abort:
+                    raise
+            self._thread.join()
+        if self._error is not None and not abort:
+            raise self._error
+
+
+def prefetch_splits(dataset: tile_and_correct_dataset) -> Iterator[tuple]:
+    """
+    Yields dataset[0], dataset[1], ... in order, loading split i + 1 in a background thread while split i is being
+    registered. Reading from disk and the float32 copy (numpy / h5py / tifffile) and the jitted registration (XLA) all
+    release the GIL, so the data loading is hidden behind the compute at the cost of holding one extra split in memory.
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        next_split = pool.submit(dataset.__getitem__, 0) if len(dataset) > 0 else None
+        for index in range(len(dataset)):
+            split = next_split.result()
+            if index + 1 < len(dataset):
+                next_split = pool.submit(dataset.__getitem__, index + 1)
+            yield split
 
 
 def calculate_splits(T: int, frames_per_split: int) -> list:
@@ -684,9 +963,30 @@ def load_split_heuristic(d1, d2, T):
     else:
         new_T = 2000
 
+    # Keep the batch a multiple of the device count so that it can be sharded across all devices
+    num_devices = jax.device_count()
+    new_T = max(num_devices, new_T - new_T % num_devices)
+
     return min(T, new_T)
 
 
+def _shard_frames(imgs: ArrayLike) -> ArrayLike:
+    '''
+    Splits a batch of frames across all available devices along the frame axis. Frames are registered independently,
+    so the jitted registration functions then run on every device in parallel. If the batch does not divide evenly
+    across the devices, it is padded by repeating the last frame; callers should trim outputs back to the
+    original number of frames. On single-device systems the frames are returned unchanged.
+    '''
+    devices = jax.devices()
+    if len(devices) == 1:
+        return imgs
+    num_pad = -imgs.shape[0] % len(devices)
+    if num_pad > 0:
+        imgs = jnp.pad(imgs, ((0, num_pad), (0, 0), (0, 0)), mode='edge')
+    mesh = jax.sharding.Mesh(np.array(devices), ('frames',))
+    return jax.device_put(imgs, jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec('frames')))
+
+
 def bin_median(mat: np.ndarray, window: int = 10, exclude_nans: bool = True):
     """
     Compute median of 3D array in along axis 0 by binning values
@@ -849,18 +1149,34 @@ def _compute_phasediff(cross_correlation_max: ArrayLike) -> ArrayLike:
     return jnp.angle(cross_correlation_max)
 
 
+def _fft2_real(image: ArrayLike) -> ArrayLike:
+    """
+    Full 2D FFT of a real image. Only the non-redundant half of the spectrum is computed (real-input FFT, about half
+    the work of a complex FFT); the other half follows from Hermitian symmetry.
+    """
+    n0, n1 = image.shape
+    half = jnp.fft.rfft2(image.astype(jnp.float32))
+    rows = (-np.arange(n0)) % n0
+    cols = n1 - np.arange(n1 // 2 + 1, n1)
+    mirrored = jnp.conj(half[rows][:, cols])
+    return jnp.concatenate([half, mirrored], axis=1)
+
+
+# @partial(jit)
+def get_freq_comp_jax(image: ArrayLike) -> ArrayLike:
+    """
+    Routine to compute the (normalized) frequency components of a single image
+    """
+    freq = _fft2_real(image)
+    return jnp.divide(freq, jnp.size(freq))
+
+
 # @partial(jit)
 def get_freq_comps_jax(src_image: ArrayLike, target_image: ArrayLike) -> tuple[ArrayLike]:
     """
     Routine to compute frequency components of two images
     """
-    src_image_cpx = jnp.complex64(src_image)
-    target_image_cpx = jnp.complex64(target_image)
-    src_freq = jnp.fft.fftn(src_image_cpx)
-    src_freq = jnp.divide(src_freq, jnp.size(src_freq))
-    target_freq = jnp.fft.fftn(target_image_cpx)
-    target_freq = jnp.divide(target_freq, jnp.size(target_freq))
-    return src_freq, target_freq
+    return get_freq_comp_jax(src_image), get_freq_comp_jax(target_image)
 
 
 # @partial(jit)
@@ -899,10 +1215,55 @@ def return_identity(a, b):
     return a
 
 
+def _overlap_correlation(src_image: ArrayLike, target_image: ArrayLike, shift: ArrayLike) -> ArrayLike:
+    """
+    Normalized (Pearson) correlation between src_image and target_image moved by an integer shift, evaluated in real
+    space over the region where the two images overlap, i.e. without the periodic wrap-around of the FFT correlation.
+    The correlation is weighted by the overlap as a fraction of the image: over only a few rows or columns it can come
+    close to +-1 by chance, and such a candidate must not outscore a large overlap with a good match.
+    """
+    shift = shift.astype(jnp.int32)
+    moved = jnp.roll(target_image, (shift[0], shift[1]), axis=(0, 1))
+    rows = jnp.arange(src_image.shape[0]) - shift[0]
+    cols = jnp.arange(src_image.shape[1]) - shift[1]
+    mask = (((rows >= 0) & (rows < src_image.shape[0]))[:, None] &
+            ((cols >= 0) & (cols < src_image.shape[1]))[None, :]).astype(jnp.float32)
+    count = jnp.maximum(jnp.sum(mask), 1.)
+    a = src_image - jnp.sum(src_image * mask) / count
+    b = moved - jnp.sum(moved * mask) / count
+    correlation = jnp.sum(a * b * mask) / jnp.sqrt(jnp.sum(a * a * mask) * jnp.sum(b * b * mask) + 1e-12)
+    return correlation * jnp.sum(mask) / mask.size
+
+
+def _disambiguate_periodic_shift(src_image: ArrayLike, target_image: ArrayLike, shifts: ArrayLike,
+                                 max_shifts: tuple[int, int]) -> ArrayLike:
+    """
+    The FFT cross-correlation only determines integer shifts modulo the image size: a peak at shift s is equally
+    explained by s - sign(s) * N along each axis. Scores the (up to) 4 periodic candidates which lie within
+    [-max_shifts, max_shifts) by their real-space correlation over the overlapping region (weighted by the size of
+    the overlap) and returns the best one.
+    Candidates outside that range are only possible if 2 * max_shifts >= N, so for the usual max_shifts this is skipped.
+    """
+    shape = jnp.array(src_image.shape, dtype=jnp.float32)
+    max_shifts = jnp.array(max_shifts, dtype=jnp.float32)
+
+    def score_candidates(shifts):
+        alternative = shifts - jnp.sign(shifts) * shape
+        candidates = jnp.array([[shifts[0], shifts[1]], [alternative[0], shifts[1]],
+                                [shifts[0], alternative[1]], [alternative[0], alternative[1]]])
+        allowed = jnp.all((candidates >= -max_shifts) & (candidates < max_shifts), axis=1)
+        allowed = allowed.at[0].set(True)
+        scores = vmap(_overlap_correlation, in_axes=(None, None, 0))(src_image, target_image, candidates)
+        return candidates[jnp.argmax(jnp.where(allowed, scores, -jnp.inf))]
+
+    return jax.lax.cond(jnp.any(2 * max_shifts >= shape), score_candidates, lambda shifts: shifts, shifts)
+
+
 # @partial(jit, static_argnums=(2,))
 def register_translation_jax_simple(src_image: ArrayLike, target_image: ArrayLike,
                                     upsample_factor: int,
-                                    max_shifts: tuple[int, int] = (10, 10)) -> tuple[ArrayLike, ArrayLike, ArrayLike]:
+                                    max_shifts: tuple[int, int] = (10, 10),
+                                    target_freq: Optional[ArrayLike] = None) -> tuple[ArrayLike, ArrayLike, ArrayLike]:
     """
     Finds optimal rigid shifts to register target_image (template) with src_image (input image). Negate
         these shifts to get the optimal rigid transformation from src_image to template.
@@ -912,6 +1273,8 @@ def register_translation_jax_simple(src_image: ArrayLike, target_image: ArrayLik
         target_image (np.ndarray). Template. Must be same dimensionality as src_image
         upsample_factor (int). Images will be registered to within 1 / upsample_factor of a pixel.
         max_shifts (tuple). Tuple of two integers describing maximum rigid shift in each dimension
+        target_freq (jnp.array). Optional. Precomputed get_freq_comp_jax(target_image); if given, target_image is
+            not transformed again.
 
     Returns:
         shifts (ndarray). Shift vector (in pixels) required to register ``target_image`` with
@@ -922,13 +1285,18 @@ def register_translation_jax_simple(src_image: ArrayLike, target_image: ArrayLik
     """
 
     ##Now, must FFT the data:
-    src_freq, target_freq = get_freq_comps_jax(src_image, target_image)
+    if target_freq is None:
+        src_freq, target_freq = get_freq_comps_jax(src_image, target_image)
+    else:
+        src_freq = get_freq_comp_jax(src_image)
 
     # Whole-pixel shift - Compute cross-correlation by an IFFT
     shape = src_freq.shape
     image_product = jnp.multiply(src_freq, jnp.conj(target_freq))
 
-    cross_correlation = jnp.fft.ifftn(image_product)
+    # Both images are real, so image_product is Hermitian and the cross-correlation is real: only invert
+    # the non-redundant half of the spectrum
+    cross_correlation = jnp.fft.irfftn(image_product[:, :shape[1] // 2 + 1], s=shape)
 
     # Locate maximum
     new_cross_corr = jnp.abs(cross_correlation)
@@ -946,6 +1314,9 @@ def register_translation_jax_simple(src_image: ArrayLike, target_image: ArrayLik
     second_shift = jax.lax.cond(shifts[1] > midpoints[1], subtract_values, return_identity, *(shifts[1], shape[1]))
     shifts = jnp.array([first_shift, second_shift])
 
+    # Large max_shifts make the whole-pixel peak ambiguous up to the image size, resolve that in real space
+    shifts = _disambiguate_periodic_shift(src_image, target_image, shifts, max_shifts)
+
     shifts = jnp.round(shifts * upsample_factor) / upsample_factor
     upsampled_region_size = int(upsample_factor * 1.5 + 0.5)
     # Center of output array at dftshift + 1
@@ -1120,7 +1491,9 @@ def register_translation_jax_full(src_image: ArrayLike, target_image: ArrayLike,
     shape = src_freq.shape
     image_product = jnp.multiply(src_freq, jnp.conj(target_freq))
 
-    cross_correlation = jnp.fft.ifftn(image_product)
+    # Both images are real, so image_product is Hermitian and the cross-correlation is real: only invert
+    # the non-redundant half of the spectrum
+    cross_correlation = jnp.fft.irfftn(image_product[:, :shape[1] // 2 + 1], s=shape)
 
     # Locate maximum
     new_cross_corr = jnp.abs(cross_correlation)
@@ -1320,9 +1693,55 @@ def return_identity_mins(in_var, k):
     return in_var
 
 
+def _crop_center(img: ArrayLike, crop_dims: Optional[tuple[int, int]]) -> ArrayLike:
+    """
+    Returns the central (crop_dims[0], crop_dims[1]) window of img. crop_dims is clipped to the image size and
+    must be static (python integers).
+    """
+    if crop_dims is None:
+        return img
+    crop_0 = min(crop_dims[0], img.shape[0])
+    crop_1 = min(crop_dims[1], img.shape[1])
+    start_0 = (img.shape[0] - crop_0) // 2
+    start_1 = (img.shape[1] - crop_1) // 2
+    return img[start_0:start_0 + crop_0, start_1:start_1 + crop_1]
+
+
+@partial(jit, static_argnames=("crop_dims",))
+def get_template_freq_jax(template: ArrayLike, add_to_movie: ArrayLike,
+                          crop_dims: Optional[tuple[int, int]] = None) -> ArrayLike:
+    """
+    Frequency components of the (offset, optionally cropped) template, as used by the rigid registration functions.
+    The template is fixed for a whole motion correction iteration, so this only needs to be computed once and can then
+    be passed to every batch via template_freq.
+    """
+    template = jnp.add(template, add_to_movie).astype(jnp.float32)
+    return get_freq_comp_jax(_crop_center(template, crop_dims))
+
+
+def apply_shifts_bilinear(img: ArrayLike, shift_a: ArrayLike, shift_b: ArrayLike) -> ArrayLike:
+    """
+    Applies rigid shifts to img by bilinear interpolation; a cheaper alternative to apply_shifts_dft_fast_1 which
+    follows the same shift convention.
+    Args:
+        img (jnp.array). Image to shift
+        shift_a (jnp.array). One element, describing shift in dimension 1
+        shift_b (jnp.array). One element, describing shift in dimension 2
+
+    Returns:
+        Shifted image. Pixels shifted in from outside the FOV take the value of the nearest edge pixel.
+    """
+    rows, cols = jnp.meshgrid(jnp.arange(img.shape[0], dtype=jnp.float32),
+                              jnp.arange(img.shape[1], dtype=jnp.float32), indexing='ij')
+    return jax.scipy.ndimage.map_coordinates(img, [rows - shift_a, cols - shift_b], order=1, mode='nearest')
+
+
 # @partial(jit, static_argnums=(4,))
 def _register_to_template_1p_rigid(img: ArrayLike, img_filtered: ArrayLike, template: ArrayLike,
-                                   max_shifts: tuple[int, int], add_to_movie: ArrayLike) -> tuple[ArrayLike, ArrayLike]:
+                                   max_shifts: tuple[int, int], add_to_movie: ArrayLike,
+                                   template_freq: Optional[ArrayLike] = None,
+                                   crop_dims: Optional[tuple[int, int]] = None,
+                                   shift_method: str = "fft") -> tuple[ArrayLike, ArrayLike]:
     """
     Same as _register_to_template_rigid; only difference is that we align img_filtered (the
     high-pass thresholded movie) to template, but we apply the compute shifts and apply those shifts to img.
@@ -1333,18 +1752,28 @@ def _register_to_template_1p_rigid(img: ArrayLike, img_filtered: ArrayLike, temp
 
     # compute rigid shifts
     rigid_shts, sfr_freq, diffphase = register_translation_jax_simple(
-        img_filtered, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts)
+        _crop_center(img_filtered, crop_dims), _crop_center(template, crop_dims),
+        upsample_factor=upsample_factor_fft, max_shifts=max_shifts, target_freq=template_freq)
 
-    # Second input doesn't matter here
-    sfr_freq, _ = get_freq_comps_jax(img, img)
-
-    new_img = apply_shifts_dft_fast_1(sfr_freq, -rigid_shts[0], -rigid_shts[1], diffphase)
+    if shift_method == "bilinear":
+        new_img = apply_shifts_bilinear(img, -rigid_shts[0], -rigid_shts[1])
+    else:
+        sfr_freq = get_freq_comp_jax(img)
+        new_img = apply_shifts_dft_fast_1(sfr_freq, -rigid_shts[0], -rigid_shts[1], diffphase)
 
     return new_img - add_to_movie, jnp.array([-rigid_shts[0], -rigid_shts[1]])
 
 
-register_frames_to_template_1p_rigid = jit(
-    vmap(_register_to_template_1p_rigid, in_axes=(0, 0, None, (None, None), None)))
+@partial(jit, static_argnames=("crop_dims", "shift_method"))
+def register_frames_to_template_1p_rigid(img: ArrayLike, img_filtered: ArrayLike, template: ArrayLike,
+                                         max_shifts: tuple[int, int], add_to_movie: ArrayLike,
+                                         crop_dims: Optional[tuple[int, int]] = None,
+                                         shift_method: str = "fft",
+                                         template_freq: Optional[ArrayLike] = None) -> tuple[ArrayLike, ArrayLike]:
+    return vmap(partial(_register_to_template_1p_rigid, crop_dims=crop_dims, shift_method=shift_method),
+                in_axes=(0, 0, None, (None, None), None, None))(img, img_filtered, template, max_shifts, add_to_movie,
+                                                                template_freq)
+
 
 register_frames_to_template_1p_rigid_docs = \
     """
@@ -1356,6 +1785,12 @@ register_frames_to_template_1p_rigid_docs = \
         template (np.array): Shape (x, y). Template image
         max_shifts (np.array): Has 2 integers specifying max shift in both FOV dimensions
         add_to_movie (np.array): Scalar value in jnp.array for adding to each frame.
+        crop_dims (tuple): Optional. Two integers; if given, shifts are estimated on the central (crop_dims[0], crop_dims[1])
+            window of img_filtered and template only, and then applied to the full frames.
+        shift_method (str): Optional. "fft" (default) applies the shifts in the frequency domain, "bilinear" uses
+            bilinear interpolation, which is cheaper but slightly smooths the registered frames.
+        template_freq (jnp.array): Optional. get_template_freq_jax(template, add_to_movie, crop_dims), to avoid
+            recomputing the template FFT for every batch of frames registered to the same template.
 
     Returns:
         aligned (jnp.array): Shape (T, x, y). Aligned version of "img" to template.
@@ -1366,7 +1801,10 @@ register_frames_to_template_1p_rigid.__doc__ = register_frames_to_template_1p_ri
 
 # @partial(jit, static_argnums=(3,))
 def _register_to_template_rigid(img: ArrayLike, template: ArrayLike,
-                                max_shifts: ArrayLike, add_to_movie: ArrayLike) -> tuple[ArrayLike, ArrayLike]:
+                                max_shifts: ArrayLike, add_to_movie: ArrayLike,
+                                template_freq: Optional[ArrayLike] = None,
+                                crop_dims: Optional[tuple[int, int]] = None,
+                                shift_method: str = "fft") -> tuple[ArrayLike, ArrayLike]:
     """
     Registers img to template, subject to constraint that max shift in either FOV dimension is bounded by values in
     max_shifts.
@@ -1376,6 +1814,10 @@ def _register_to_template_rigid(img: ArrayLike, template: ArrayLike,
         template (jnp.array): Template image
         max_shifts (jnp.array): Has 2 integers specifying max shift in both FOV dimensions
         add_to_movie (jnp.array): Scalar value in jnp.array for adding to each frame.
+        template_freq (jnp.array): Optional. Precomputed frequency components of the template (see
+            get_template_freq_jax).
+        crop_dims (tuple): Optional. Static size of the central window used to estimate the shifts.
+        shift_method (str): Optional. Static; "fft" or "bilinear", how the estimated shifts are applied to img.
     Returns:
         aligned (jnp.array): Aligned version of "img" to template.
         shifts (jnp.array): Shifts which were applied to img.
@@ -1386,15 +1828,35 @@ def _register_to_template_rigid(img: ArrayLike, template: ArrayLike,
     template = jnp.add(template, add_to_movie).astype(jnp.float32)
 
     # compute rigid shifts
-    rigid_shts, sfr_freq, diffphase = register_translation_jax_simple(
-        img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts)
-
-    new_img = apply_shifts_dft_fast_1(sfr_freq, -rigid_shts[0], -rigid_shts[1], diffphase)
+    if crop_dims is None:
+        rigid_shts, sfr_freq, diffphase = register_translation_jax_simple(
+            img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, target_freq=template_freq)
+    else:
+        # All pixels share the same rigid shift, so a central window is enough to estimate it
+        rigid_shts, _, diffphase = register_translation_jax_simple(
+            _crop_center(img, crop_dims), _crop_center(template, crop_dims),
+            upsample_factor=upsample_factor_fft, max_shifts=max_shifts, target_freq=template_freq)
+        sfr_freq = None
+
+    if shift_method == "bilinear":
+        new_img = apply_shifts_bilinear(img, -rigid_shts[0], -rigid_shts[1])
+    else:
+        if sfr_freq is None:
+            sfr_freq = get_freq_comp_jax(img)
+        new_img = apply_shifts_dft_fast_1(sfr_freq, -rigid_shts[0], -rigid_shts[1], diffphase)
 
     return new_img - add_to_movie, jnp.array([-rigid_shts[0], -rigid_shts[1]])
 
 
-register_frames_to_template_rigid = jit(vmap(_register_to_template_rigid, in_axes=(0, None, None, None)))
+@partial(jit, static_argnames=("crop_dims", "shift_method"))
+def register_frames_to_template_rigid(img: ArrayLike, template: ArrayLike, max_shifts: ArrayLike,
+                                      add_to_movie: ArrayLike,
+                                      crop_dims: Optional[tuple[int, int]] = None,
+                                      shift_method: str = "fft",
+                                      template_freq: Optional[ArrayLike] = None) -> tuple[ArrayLike, ArrayLike]:
+    return vmap(partial(_register_to_template_rigid, crop_dims=crop_dims, shift_method=shift_method),
+                in_axes=(0, None, None, None, None))(img, template, max_shifts, add_to_movie, template_freq)
+
 
 register_frames_to_template_rigid_docs = \
     """
@@ -1405,6 +1867,12 @@ register_frames_to_template_rigid_docs = \
         template (jnp.array): Shape (x, y). Template image
         max_shifts (jnp.array): Has 2 integers specifying max shift in both FOV dimensions
         add_to_movie (jnp.array): Scalar value in jnp.array for adding to each frame.
+        crop_dims (tuple): Optional. Two integers; if given, shifts are estimated on the central (crop_dims[0], crop_dims[1])
+            window of img and template only, and then applied to the full frames.
+        shift_method (str): Optional. "fft" (default) applies the shifts in the frequency domain, "bilinear" uses
+            bilinear interpolation, which is cheaper but slightly smooths the registered frames.
+        template_freq (jnp.array): Optional. get_template_freq_jax(template, add_to_movie, crop_dims), to avoid
+            recomputing the template FFT for every batch of frames registered to the same template.
         
     Returns:
         aligned (jnp.array): Shape (T, x, y).  Aligned version of "img" to template.
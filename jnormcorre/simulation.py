@@ -50,21 +50,6 @@ class SimData:
             self.m_x = np.random.uniform(-max_drift, max_drift)
             self.m_y = np.random.uniform(-max_drift, max_drift)
 
-    def generate_gaussian_blob(self, x, y, x0, y0, sigma, amplitude):
-        """
-        Generate a 2D Gaussian blob at a given location with specified parameters.
-
-        Parameters:
-        - x, y: Meshgrid for the image dimensions.
-        - x0, y0: Center of the gaussian blob.
-        - sigma: Standard deviation of the gaussian blob.
-        - amplitude: Amplitude of the gaussian blob (can be negative for valleys).
-
-        Returns:
-        - 2D numpy array representing the gaussian blob.
-        """
-        return amplitude * np.exp(-((x-x0)**2 + (y-y0)**2) / (2 * sigma**2))
-
     def generate_base_image(self, padding=0):
         """
         Generate a base image consisting of a noise floor and random gaussian blobs.
@@ -81,20 +66,18 @@ class SimData:
         # Create a noise floor using random values
         noise_floor = self.background_noise * np.random.randn(X_padded, Y_padded)
 
-        x = np.arange(X_padded)
-        y = np.arange(Y_padded)
-        x, y = np.meshgrid(x, y, indexing='ij')
-
-        # Add random gaussian blobs (peaks or valleys) to the noise floor
-        for _ in range(self.n_blobs):
-            x0 = np.random.randint(X_padded)
-            y0 = np.random.randint(Y_padded)
-            sigma = np.random.uniform(5, 15)
-            if np.random.rand() < 0.5:
-                amplitude = np.random.uniform(1, self.blob_amplitude)
-            else:
-                amplitude = np.random.uniform(-1, -self.blob_amplitude)
-            noise_floor += self.generate_gaussian_blob(x, y, x0, y0, sigma, amplitude)
+        # Draw random gaussian blobs (peaks or valleys)
+        x0 = np.random.randint(X_padded, size=self.n_blobs)
+        y0 = np.random.randint(Y_padded, size=self.n_blobs)
+        sigma = np.random.uniform(5, 15, size=self.n_blobs)
+        sign = np.where(np.random.rand(self.n_blobs) < 0.5, 1, -1)
+        amplitude = sign * np.random.uniform(1, self.blob_amplitude, size=self.n_blobs)
+
+        # Each blob is separable, exp(-dx^2 / 2s^2) * exp(-dy^2 / 2s^2), so the sum over all blobs is a single
+        # (X_padded, n_blobs) @ (n_blobs, Y_padded) matrix product
+        blobs_x = amplitude * np.exp(-(np.arange(X_padded)[:, None] - x0)**2 / (2 * sigma**2))
+        blobs_y = np.exp(-(np.arange(Y_padded)[:, None] - y0)**2 / (2 * sigma**2))
+        noise_floor += blobs_x @ blobs_y.T
         return noise_floor
 
     def calculate_padding(self):
@@ -124,40 +107,35 @@ class SimData:
         """
         padding = self.calculate_padding()
         large_base_image = self.generate_base_image(padding)
+
+        # Draw the random jitter for all frames at once
+        t = np.arange(self.frames)
+        jitter_x = np.random.uniform(-self.max_jitter, self.max_jitter, size=self.frames)
+        jitter_y = np.random.uniform(-self.max_jitter, self.max_jitter, size=self.frames)
+
+        # Calculate the drift for every frame (linear or quadratic)
+        if self.drift_type == 'linear':
+            drift_x = self.m_x * t
+            drift_y = self.m_y * t
+        else:
+            drift_x = self.a_x * t**2 + self.b_x * t
+            drift_y = self.a_y * t**2 + self.b_y * t
+
+        # Combine the drift and jitter to get the total shift for each frame
+        shifts_x = jitter_x + drift_x
+        shifts_y = jitter_y + drift_y
+        shifts = list(zip(shifts_x.tolist(), shifts_y.tolist()))
+
+        # Frame-by-frame shot noise, only drawn for the field of view we keep
+        noise = self.shot_noise * np.random.randn(self.frames, self.X, self.Y)
+
         self.data = np.zeros((self.frames, self.X, self.Y))
-        shifts = []
-        for t in tqdm(range(self.frames)):
-            # Add random jitter for the current frame
-            jitter_x = np.random.uniform(-self.max_jitter, self.max_jitter)
-            jitter_y = np.random.uniform(-self.max_jitter, self.max_jitter)
-
-            # Calculate the drift for the current frame (linear or quadratic)
-            if self.drift_type == 'linear':
-                drift_x = self.m_x * t
-                drift_y = self.m_y * t
-            else:
-                drift_x = self.a_x * t**2 + self.b_x * t
-                drift_y = self.a_y * t**2 + self.b_y * t
-
-            # Combine the drift and jitter to get the total shift for the current frame
-            shift_x = jitter_x + drift_x
-            shift_y = jitter_y + drift_y
-            shifts.append((shift_x, shift_y))
-
-            # Apply the shift using an affine transformation
-            transformation_matrix = np.array([[1, 0, -shift_x], [0, 1, -shift_y], [0, 0, 1]])
-            shifted_image = affine_transform(large_base_image, transformation_matrix[:2, :2],
-                                             offset=transformation_matrix[:2, 2], mode='nearest', order=1)
-
-            # Add frame-by-frame shot noise to the image
-            shifted_image += self.shot_noise * np.random.randn(self.X + 2 * padding, self.Y + 2 * padding)
-
-            # Extract the relevant section of the shifted image for the current frame
-            start_x = padding
-            end_x = start_x + self.X
-            start_y = padding
-            end_y = start_y + self.Y
-            self.data[t] = shifted_image[start_x:end_x, start_y:end_y]
+        for k in tqdm(range(self.frames)):
+            # Apply the shift using an affine transformation, only evaluating the output over the cropped FOV
+            shifted_image = affine_transform(large_base_image, np.eye(2),
+                                             offset=(padding - shifts_x[k], padding - shifts_y[k]),
+                                             output_shape=(self.X, self.Y), mode='nearest', order=1)
+            self.data[k] = shifted_image + noise[k]
         self.shifts = shifts
         return self.data, shifts
 
@@ -9,7 +9,7 @@ setuptools.setup(
     version="1.0.0",
     description="Jax-accelerated implementation of normcorre",
     packages=setuptools.find_packages(),
-    install_requires=["future","numpy", "scipy", "h5py", "tqdm", "matplotlib", "opencv-python", "tifffile", "typing", "torch", "pynwb", "pillow", "scikit-image", "jax", "jaxlib", "pytest"],
+    install_requires=["future","numpy", "scipy", "h5py", "tqdm", "matplotlib", "opencv-python", "tifffile", "typing", "pynwb", "pillow", "scikit-image", "jax", "jaxlib", "pytest"],
     classifiers=(
         "Programming Language :: Python :: 3",
     ),
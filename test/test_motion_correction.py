@@ -1,10 +1,17 @@
+import os
+import subprocess
+import sys
 import tempfile
+import textwrap
+import threading
 from pathlib import Path
 
 import numpy as np
 import pytest
 import tifffile
 import h5py
+import jax
+import scipy.ndimage
 
 import jnormcorre.motion_correction
 from jnormcorre.simulation import SimData
@@ -12,6 +19,13 @@ from jnormcorre.motion_correction import MotionCorrect
 from jnormcorre.utils import registrationarrays
 
 
+def _pearson(a, b):
+    # Pearson correlation of two 1d arrays without building the full np.corrcoef covariance matrix
+    a = a - a.mean()
+    b = b - b.mean()
+    return (a @ b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
 class Test_Simulation:
 
     @pytest.mark.parametrize("frames", [10, 50, 100])
@@ -69,6 +83,15 @@ class Test_mc:
         self.data = data
         self.shifts = shifts
 
+    def seeded_sample(self, seed=0):
+
+        # fixed data for tests which compare two registration settings against each other
+        np.random.seed(seed)
+        sim = SimData(frames=self.frames, X=self.X, Y=self.Y, n_blobs=10, noise_amplitude=0.2,
+                      blob_amplitude=5, max_drift=(0.0001, 0.01), max_jitter=1,
+                      background_noise=1, shot_noise=0.2)
+        return sim.simulate()[0]
+
     @pytest.mark.parametrize("file_type", [("test.tiff", ""), ("test.h5", "data"),
                                            ("test.h5", "data/ch0"), ("test.h5", "data/ch0/dff")])
     def test_file(self, file_type):
@@ -199,6 +222,25 @@ class Test_mc:
         # test correct shift reconstruction
         np.allclose(shifts, calc_shifts), f"calculated shifts are to different from True value"
 
+    @pytest.mark.parametrize("pw_rigid", [True, False])
+    def test_shift_correlation(self, pw_rigid):
+
+        np.random.seed(0)
+        sim = SimData(frames=25, X=self.X, Y=self.Y, n_blobs=10, noise_amplitude=0.2,
+                      blob_amplitude=5, max_drift=(1e-3, 1e-2), max_jitter=1,
+                      background_noise=1, shot_noise=0.2)
+        data, shifts = sim.simulate()
+
+        mc = MotionCorrect(data,
+                           max_shifts=(6, 6), niter_rig=4, frames_per_split=1000, strides=(50, 50),
+                           overlaps=(10, 10), pw_rigid=pw_rigid, gSig_filt=None, min_mov=-1)
+        mc.motion_correct(save_movie=False)
+
+        # the applied shifts undo the simulated movement, so they should be strongly anti-correlated with it
+        shifts, calc_shifts = np.array(shifts), np.array(mc.shifts_rig)
+        for dim in range(2):
+            assert _pearson(-shifts[:, dim], calc_shifts[:, dim]) > 0.9, f"rigid shifts do not track the movement"
+
     @pytest.mark.xfail(reason="movement that exceeds capabilities")
     @pytest.mark.parametrize("n_frames", [400])
     @pytest.mark.parametrize("pw_rigid", [True, False])
@@ -304,3 +346,285 @@ class Test_mc:
         registered_data = registration_arr[:num_frames, :, :]
         #Verify that the registration object gives you the same results as the
         np.allclose(saved_dataset[:num_frames, :, :], registered_data), f"calculated shifts are to different from True value"
+
+    @pytest.mark.parametrize("n_frames", [1, 7, 25])
+    def test_shard_frames(self, n_frames):
+
+        imgs = self.data[:n_frames].astype(np.float32)
+        sharded = jnormcorre.motion_correction._shard_frames(imgs)
+
+        # the batch is padded up to a multiple of the device count, the original frames must be unchanged
+        assert sharded.shape[0] % jax.device_count() == 0
+        assert np.array_equal(np.asarray(sharded)[:n_frames], imgs)
+
+    def test_shard_frames_multi_device(self):
+
+        # jax fixes the device count at start up, so force 3 host devices in a separate process; 25 frames do not
+        # divide across them, which exercises the padding and trimming
+        script = textwrap.dedent("""
+            import sys
+            import jax
+            import numpy as np
+            import jnormcorre.motion_correction as mcorr
+
+            assert jax.device_count() == 3
+            assert mcorr.load_split_heuristic(100, 100, 5000) == 1998
+            assert mcorr.load_split_heuristic(600, 600, 5000) == 18
+
+            data = np.load(sys.argv[1])
+            sharded = mcorr._shard_frames(data[:7].astype(np.float32))
+            assert sharded.shape[0] == 9 and len(sharded.sharding.device_set) == 3
+            assert np.array_equal(np.asarray(sharded)[:7], data[:7].astype(np.float32))
+
+            mc = mcorr.MotionCorrect(data, max_shifts=(6, 6), niter_rig=2, pw_rigid=False, min_mov=-5)
+            mc.motion_correct(save_movie=False)
+            np.save(sys.argv[2], np.array(mc.shifts_rig))
+        """)
+
+        input_ = self.seeded_sample()
+        mc = MotionCorrect(input_, max_shifts=(6, 6), niter_rig=2, pw_rigid=False, min_mov=-5)
+        mc.motion_correct(save_movie=False)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_file = str(Path(tmp_dir).joinpath("data.npy"))
+            shifts_file = str(Path(tmp_dir).joinpath("shifts.npy"))
+            np.save(data_file, input_)
+            env = dict(os.environ, JAX_PLATFORMS="cpu", XLA_FLAGS="--xla_force_host_platform_device_count=3")
+            result = subprocess.run([sys.executable, "-c", script, data_file, shifts_file], env=env, cwd=tmp_dir,
+                                    capture_output=True, text=True)
+            assert result.returncode == 0, result.stderr
+            shifts_rig = np.load(shifts_file)
+
+        assert np.allclose(shifts_rig, np.array(mc.shifts_rig)), f"sharded registration changes the shifts"
+
+    @pytest.mark.parametrize("gSig_filt", [None, (10, 10)])
+    def test_rigid_crop(self, gSig_filt):
+
+        input_ = self.seeded_sample(seed=2)
+
+        shifts_rig = []
+        for rigid_crop in [None, (60, 60)]:
+            mc = MotionCorrect(input_,
+                               max_shifts=(6, 6), niter_rig=4, frames_per_split=1000, pw_rigid=False,
+                               gSig_filt=gSig_filt, min_mov=-5, rigid_crop=rigid_crop)
+            mc.motion_correct(save_movie=False)
+            shifts_rig.append(np.array(mc.shifts_rig))
+
+        # estimating rigid shifts on a central window should agree with the full FOV estimate, up to a global offset
+        # (the template is re-estimated from the registered frames, so both runs can settle on differently centered
+        # templates)
+        deviation = shifts_rig[0] - shifts_rig[1]
+        deviation -= np.median(deviation, axis=0)
+        assert np.max(np.abs(deviation)) <= 1, f"cropped rigid shifts deviate too much"
+
+    def test_rigid_crop_too_small(self):
+
+        with pytest.raises(ValueError):
+            MotionCorrect(self.data, max_shifts=(6, 6), rigid_crop=(10, 10))
+
+    @pytest.mark.parametrize("gSig_filt", [None, (3, 3)])
+    def test_shift_method_bilinear(self, gSig_filt):
+
+        input_ = self.data
+
+        shifts_rig = []
+        for shift_method in ["fft", "bilinear"]:
+            # a single iteration registers to the same initial template, later templates are built from the shifted
+            # frames and differ between the methods
+            mc = MotionCorrect(input_,
+                               max_shifts=(6, 6), niter_rig=1, frames_per_split=1000, pw_rigid=False,
+                               gSig_filt=gSig_filt, min_mov=-5, shift_method=shift_method)
+            mc.motion_correct(save_movie=False)
+            shifts_rig.append(np.array(mc.shifts_rig))
+
+        # both methods estimate shifts the same way, only applying them differs
+        assert np.array_equal(shifts_rig[0], shifts_rig[1]), f"bilinear rigid shifts differ from fft"
+
+    def test_apply_shifts_bilinear(self):
+
+        mcorr = jnormcorre.motion_correction
+        img = np.asarray(self.data[0], dtype=np.float32)
+        shifted_fft = np.asarray(mcorr.apply_shifts_dft_fast_1(mcorr.get_freq_comp_jax(img), 2., -3., 0.))
+        shifted_bilinear = np.asarray(mcorr.apply_shifts_bilinear(img, 2., -3.))
+
+        # integer shifts match exactly away from the borders, where fft wraps and bilinear repeats the edge
+        assert np.allclose(shifted_fft[5:-5, 5:-5], shifted_bilinear[5:-5, 5:-5], atol=1e-3)
+
+    @pytest.mark.parametrize("rigid_crop", [None, (60, 60)])
+    def test_template_freq(self, rigid_crop):
+
+        mcorr = jnormcorre.motion_correction
+        frames = np.asarray(self.data, dtype=np.float32)
+        template = np.median(frames, axis=0)
+        add_to_movie = np.array(5, dtype=np.float32)
+
+        template_freq = mcorr.get_template_freq_jax(template, add_to_movie, crop_dims=rigid_crop)
+        cached = mcorr.register_frames_to_template_rigid(frames, template, (6, 6), add_to_movie,
+                                                         crop_dims=rigid_crop, template_freq=template_freq)
+        uncached = mcorr.register_frames_to_template_rigid(frames, template, (6, 6), add_to_movie,
+                                                           crop_dims=rigid_crop)
+
+        assert np.allclose(cached[1], uncached[1]), f"precomputed template FFT changes the shifts"
+        assert np.allclose(cached[0], uncached[0], atol=1e-4), f"precomputed template FFT changes the frames"
+
+    def test_frame_corrector_template_update(self):
+
+        mcorr = jnormcorre.motion_correction
+        frames = np.asarray(self.data, dtype=np.float32)
+        template = np.median(frames, axis=0)
+        new_template = np.roll(template, (3, -2), axis=(0, 1))
+
+        fc = mcorr.frame_corrector(template, (6, 6), (50, 50), (10, 10), 3, min_mov=-5)
+        fc.template = new_template
+        fresh = mcorr.frame_corrector(new_template, (6, 6), (50, 50), (10, 10), 3, min_mov=-5)
+
+        assert np.array_equal(fc.register_frames(frames), fresh.register_frames(frames)), \
+            f"reassigned template is not used for rigid registration"
+
+    @pytest.mark.parametrize("pw_rigid", [True, False])
+    def test_dtype_corr(self, pw_rigid):
+
+        input_ = self.seeded_sample()
+
+        shifts = []
+        for dtype_corr in [np.float32, jax.numpy.bfloat16]:
+            mc = MotionCorrect(input_,
+                               max_shifts=(6, 6), niter_rig=4, frames_per_split=1000, pw_rigid=pw_rigid,
+                               strides=(50, 50), overlaps=(10, 10), gSig_filt=(3, 3), min_mov=-5,
+                               dtype_corr=dtype_corr)
+            mc.motion_correct(save_movie=False)
+            shifts.append([np.array(mc.shifts_rig)] +
+                          ([np.array(mc.x_shifts_els), np.array(mc.y_shifts_els)] if pw_rigid else []))
+
+        # low precision filtered frames should only perturb the shifts by about one upsampling step (0.1 px)
+        for shifts_f32, shifts_bf16 in zip(*shifts):
+            assert np.max(np.abs(shifts_f32 - shifts_bf16)) <= 0.25, f"bfloat16 shifts deviate too much"
+
+    def test_dtype_corr_invalid(self):
+
+        with pytest.raises(ValueError):
+            MotionCorrect(self.data, max_shifts=(6, 6), dtype_corr=np.int16)
+
+    def test_canonical_int_pair(self):
+
+        mc = MotionCorrect(self.data, max_shifts=[np.int64(6), 6.0], strides=np.array([50, 50]), overlaps=(10, 10))
+        for pair in (mc.max_shifts, mc.strides, mc.overlaps):
+            assert isinstance(pair, tuple) and all(type(v) is int for v in pair)
+
+        with pytest.raises(ValueError):
+            MotionCorrect(self.data, max_shifts=(6.5, 6))
+
+    def test_time_axis(self):
+
+        input_ = self.seeded_sample()
+
+        shifts_rig = []
+        for data, time_axis in [(input_, 0), (np.moveaxis(input_, 0, 2), 2)]:
+            mc = MotionCorrect(data, max_shifts=(6, 6), niter_rig=2, frames_per_split=1000, pw_rigid=False,
+                               min_mov=-5, time_axis=time_axis)
+            mc.motion_correct(save_movie=False)
+            shifts_rig.append(np.array(mc.shifts_rig))
+
+        assert np.allclose(shifts_rig[0], shifts_rig[1]), f"time_axis changes the registration"
+
+    def test_time_axis_lazy_loader(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_ = self.save_sample(Path(tmp_dir).joinpath("test.tiff"), self.data)
+            lazy_dataset = registrationarrays.TiffArray(input_)
+
+            with pytest.raises(ValueError):
+                MotionCorrect(lazy_dataset, max_shifts=(6, 6), time_axis=2)
+
+    @pytest.mark.parametrize("true_shift", [(30, 0), (5, 3)])
+    def test_periodic_shift_disambiguation(self, true_shift):
+
+        # with max_shifts >= N / 2, a 30 pixel shift of a 48 pixel window aliases to -18 in the FFT correlation
+        rng = np.random.default_rng(0)
+        base = scipy.ndimage.gaussian_filter(rng.standard_normal((200, 200)), 2).astype(np.float32)
+        n, (s0, s1) = 48, true_shift
+        template = base[50:50 + n, 50:50 + n]
+        img = base[50 - s0:50 - s0 + n, 50 - s1:50 - s1 + n]
+
+        shifts = jnormcorre.motion_correction.register_translation_jax_simple(img, template, 10, max_shifts=(32, 32))[0]
+        assert np.max(np.abs(np.array(shifts) - np.array(true_shift))) <= 1, f"periodic shift was not resolved"
+
+    def test_periodic_shift_small_overlap(self):
+
+        # the periodic alias (-46, 0) of a (2, 0) shift only overlaps by two rows; make those rows match exactly, so
+        # that it correlates perfectly while the true shift only matches up to noise
+        rng = np.random.default_rng(0)
+        base = scipy.ndimage.gaussian_filter(rng.standard_normal((200, 200)), 3).astype(np.float32)
+        n = 48
+        template = base[50:50 + n, 50:50 + n].copy()
+        img = base[48:48 + n, 50:50 + n] + template.std() * rng.standard_normal((n, n)).astype(np.float32)
+        template[-2:] = img[:2]
+
+        shifts = jnormcorre.motion_correction.register_translation_jax_simple(img, template, 10, max_shifts=(46, 46))[0]
+        assert np.max(np.abs(np.array(shifts) - np.array([2, 0]))) <= 1, f"small overlap candidate was chosen"
+
+    @pytest.mark.parametrize("pw_rigid", [True, False])
+    def test_compression(self, pw_rigid):
+
+        input_ = self.seeded_sample()
+
+        movies = []
+        for compression in [None, "zlib"]:
+            # frames_per_split=10 over 25 frames makes the last split overlap the previous one
+            mc = MotionCorrect(input_, max_shifts=(6, 6), niter_rig=2, frames_per_split=10, pw_rigid=pw_rigid,
+                               strides=(50, 50), overlaps=(10, 10), min_mov=-5, compression=compression)
+            np.random.seed(0)
+            _, target_file = mc.motion_correct(save_movie=True)
+            movies.append(tifffile.imread(target_file))
+
+        assert movies[0].shape == input_.shape
+        assert np.array_equal(movies[0], movies[1]), f"compressed movie differs from the uncompressed one"
+
+    def test_writer_closed_on_error(self, monkeypatch):
+
+        register_batch = jnormcorre.motion_correction._register_batch
+        calls = []
+
+        def failing_register_batch(*args, **kwargs):
+            calls.append(1)
+            if len(calls) > 1:
+                raise RuntimeError("registration failed")
+            return register_batch(*args, **kwargs)
+
+        monkeypatch.setattr(jnormcorre.motion_correction, "_register_batch", failing_register_batch)
+        threads = set(threading.enumerate())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_fname = str(Path(tmp_dir).joinpath("out.tiff"))
+            template = np.median(self.data, axis=0)
+            # two rigid splits, the second one fails after the first was queued for writing
+            param_list = [(self.data, out_fname, idxs, template, None, None, (6, 6), 5, 0, 4, None)
+                          for idxs in [slice(0, 10), slice(10, 20)]]
+            with pytest.raises(RuntimeError, match="registration failed"):
+                jnormcorre.motion_correction._tile_and_correct_dataloader(param_list, self.data)
+
+            assert set(threading.enumerate()) <= threads, f"writer thread is still running after the error"
+            assert Path(out_fname).exists(), f"partial movie was not closed"
+
+    def test_shift_method_invalid(self):
+
+        with pytest.raises(ValueError):
+            MotionCorrect(self.data, max_shifts=(6, 6), shift_method="cubic")
+
+    @pytest.mark.parametrize("gSig_filt", [None, (3, 3)])
+    def test_warmup(self, gSig_filt):
+
+        # a FOV shape no other test uses, so the kernels are not compiled for it yet
+        input_ = self.seeded_sample()[:, :83, :77]
+        mc = MotionCorrect(input_, max_shifts=(6, 6), niter_rig=2, frames_per_split=10, pw_rigid=True,
+                           strides=(40, 40), overlaps=(10, 10), min_mov=-5, gSig_filt=gSig_filt)
+        mc.warmup()
+
+        kernels = [jnormcorre.motion_correction.register_frames_to_template_rigid,
+                   jnormcorre.motion_correction.register_frames_to_template_1p_rigid,
+                   jnormcorre.motion_correction.register_frames_to_template_pwrigid,
+                   jnormcorre.motion_correction.register_frames_to_template_1p_pwrigid]
+        # _cache_size() is a private API of jax's jitted functions (the number of compiled variants); there is no
+        # public way to count compilations
+        cache_sizes = [kernel._cache_size() for kernel in kernels]
+        mc.motion_correct(save_movie=True)
+        assert [kernel._cache_size() for kernel in kernels] == cache_sizes, f"motion_correct recompiled after warmup"